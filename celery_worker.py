@@ -1,7 +1,21 @@
 from celery import Celery
+from celery.signals import worker_init, worker_process_init
 from minio import Minio
+from minio.commonconfig import SnowballObject
 from minio.error import S3Error
+from minio_http import create_http_client
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from datetime import timedelta
 import subprocess
+import functools
+import tempfile
+import shutil
+import threading
+import time
+import io
+import json
+import re
 import os
 from pathlib import Path
 import logging
@@ -15,6 +29,8 @@ celery_app = Celery(
     backend=os.getenv('REDIS_URL', 'redis://redis:6379/0')
 )
 
+TASK_TIME_LIMIT = 3600  # 1 hour max
+
 celery_app.conf.update(
     task_serializer='json',
     accept_content=['json'],
@@ -22,8 +38,12 @@ celery_app.conf.update(
     timezone='UTC',
     enable_utc=True,
     task_track_started=True,
-    task_time_limit=3600,  # 1 hour max
+    task_time_limit=TASK_TIME_LIMIT,
     task_soft_time_limit=3300,  # 55 minutes soft limit
+    # Each FFmpeg run already uses every core, so one transcode per worker; scale out
+    # with more worker containers instead. Prefetch 1 leaves queued jobs to idle workers.
+    worker_concurrency=1,
+    worker_prefetch_multiplier=1,
 )
 
 # MinIO Configuration
@@ -35,161 +55,819 @@ MINIO_SECURE = os.getenv("MINIO_SECURE", "false").lower() == "true"
 INPUT_BUCKET = "videobucket"
 OUTPUT_BUCKET = "videobucket"
 
+# The presigned input URL must stay valid for as long as a task can run
+INPUT_URL_EXPIRY = timedelta(seconds=TASK_TIME_LIMIT)
+# The input is streamed over HTTP for the whole encode, so a dropped connection is
+# resumed with a range request rather than failing (and retrying) the entire task
+INPUT_RECONNECT_ARGS = ["-reconnect", "1", "-reconnect_on_network_error", "1", "-reconnect_delay_max", "5"]
+# Give up on a read that stalls for 30 s (in microseconds); without it a hung connection
+# blocks FFmpeg/ffprobe until the task time limit kills the worker
+INPUT_TIMEOUT_ARGS = ["-rw_timeout", "30000000"]
+# Upper bound for the source probe, which only reads the header
+PROBE_TIMEOUT = 120
+
+# MP4/MOV keep every stream's parameters in the moov header, so probing them needs far
+# less than FFmpeg's default 5 MB / 5 s of input; over HTTP that's fewer bytes before encoding
+FAST_PROBE_SUFFIXES = (".mp4", ".m4v", ".mov")
+FAST_PROBE_ARGS = ["-probesize", "1M", "-analyzeduration", "1M"]
+# Regenerate missing timestamps and drop corrupt packets instead of failing on them
+DEMUX_FLAGS = ["-fflags", "+genpts+discardcorrupt"]
+
+# Part size for streamed uploads; MinIO switches to multipart once the stream exceeds
+# one part, so small outputs still go up as a single PUT
+UPLOAD_PART_SIZE = 64 * 1024 * 1024
+# Parts uploaded concurrently; each in-flight part is held in memory (8 x 64 MiB worst case)
+UPLOAD_PARALLEL_PARTS = 8
+
+# Segment uploads are round-trip bound, so many of them run at once
+UPLOAD_WORKERS = 16
+UPLOAD_MAX_RETRIES = 3
+
+# Finished segments are collected across polls and go up together as one snowball upload:
+# a tar that MinIO auto-extracts into separate objects (typed by extension), one request
+# per batch. A batch is sent once it reaches SNOWBALL_BATCH_BYTES, once its oldest segment
+# has waited SNOWBALL_MAX_WAIT seconds, or when FFmpeg exits.
+SNOWBALL_BATCH_BYTES = 64 * 1024 * 1024
+SNOWBALL_MAX_WAIT = 10.0
+
+CONTENT_TYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".mpd": "application/dash+xml",
+    ".ts": "video/mp2t",
+    ".m4s": "video/iso.segment",
+    ".mp4": "video/mp4",
+}
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+MANIFEST_SUFFIXES = (".m3u8", ".mpd")
+
+# How often the work directory is checked for finished segments while FFmpeg runs
+SEGMENT_POLL_INTERVAL = 1.0
+
+# Encoder output is buffered ahead of the uploader so bitrate bursts and slow part
+# uploads don't stall each other through the 64 KiB OS pipe
+STREAM_BUFFER_SIZE = 64 * 1024 * 1024
+STREAM_READ_SIZE = 1024 * 1024
+
+# Only the tail of FFmpeg's log is kept, for error reporting
+STDERR_TAIL_LINES = 200
+# FFmpeg writes machine-readable progress as key=value lines to stderr, one block per
+# update ending in "progress=...". Log messages never take that form, so they're told apart.
+# Some values are space-padded ("speed=   1x", "bitrate= 123.4kbits/s").
+PROGRESS_ARGS = ["-progress", "pipe:2", "-nostats"]
+PROGRESS_RE = re.compile(r"(\w+)=\s*(\S*)")
+
 # Initialize MinIO client
 minio_client = Minio(
     MINIO_ENDPOINT,
     access_key=MINIO_ACCESS_KEY,
     secret_key=MINIO_SECRET_KEY,
-    secure=MINIO_SECURE
+    secure=MINIO_SECURE,
+    http_client=create_http_client()
 )
 
 
+@worker_process_init.connect
+def warm_minio_pool(**kwargs):
+    """Open a MinIO connection in each worker process before the first task arrives"""
+    # Runs after the prefork fork, so no socket is ever shared between processes
+    try:
+        minio_client.bucket_exists(INPUT_BUCKET)
+    except Exception as e:
+        logger.warning(f"MinIO warm-up failed: {e}")
+
+
+class FFmpegError(subprocess.CalledProcessError):
+    """FFmpeg failure that also records how many frames were encoded before it"""
+
+    def __init__(self, returncode, cmd, stderr=None, frames=0):
+        super().__init__(returncode, cmd, stderr=stderr)
+        self.frames = frames
+
+
+class FFmpegProcess:
+    """FFmpeg subprocess whose stderr is drained on a background thread.
+
+    Draining keeps the pipe from filling up and stalling the encoder, holds only the last
+    STDERR_TAIL_LINES log lines in memory, and reports each -progress block as task progress
+    (a percentage when the source duration is known).
+    """
+
+    def __init__(self, task, cmd, stdout=subprocess.DEVNULL, duration=None):
+        self.cmd = cmd
+        self.duration = duration
+        self.stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+        self.frames = 0
+        self.process = subprocess.Popen(cmd, stdout=stdout, stderr=subprocess.PIPE, bufsize=0)
+        # task.request is thread-local, so the id is captured here for the drain thread
+        self.drain_thread = threading.Thread(
+            target=self._drain_stderr, args=(task, task.request.id), daemon=True
+        )
+        self.drain_thread.start()
+
+    def _drain_stderr(self, task, task_id):
+        # FFmpeg ends stats lines with '\r'; newline='' splits on those as well as '\n'
+        stderr = io.TextIOWrapper(self.process.stderr, encoding="utf-8", errors="replace", newline="")
+        progress = {}
+        for line in stderr:
+            line = line.strip()
+            if not line:
+                continue
+            match = PROGRESS_RE.fullmatch(line)
+            if not match:
+                self.stderr_tail.append(line)
+                continue
+            progress[match.group(1)] = match.group(2)
+            if match.group(1) == "progress":
+                meta = self._progress_meta(progress)
+                self.frames = meta.get('frame', self.frames)
+                task.update_state(task_id=task_id, state='PROGRESS', meta=meta)
+
+    def _progress_meta(self, progress):
+        meta = {'status': 'transcoding'}
+        if progress.get("frame", "").isdigit():
+            meta['frame'] = int(progress["frame"])
+        # out_time_us is missing from older FFmpeg, whose out_time_ms holds microseconds too
+        out_time = progress.get("out_time_us", progress.get("out_time_ms", ""))
+        if self.duration and out_time.isdigit():
+            meta['percent'] = round(min(int(out_time) / 1e6 / self.duration, 1.0) * 100, 1)
+        return meta
+
+    def wait(self):
+        """Wait for FFmpeg to exit, raising FFmpegError with the log tail on failure"""
+        returncode = self.process.wait()
+        self.drain_thread.join()
+        if returncode:
+            raise FFmpegError(returncode, self.cmd, stderr="\n".join(self.stderr_tail), frames=self.frames)
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+
+
+class RingBuffer:
+    """Bounded byte buffer between one producer thread and one consumer thread"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.chunks = deque()
+        self.size = 0
+        self.eof = False
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def write(self, data: bytes) -> bool:
+        """Append data, blocking while the buffer is full. Returns False once the consumer has closed it."""
+        with self.cond:
+            while self.size >= self.capacity and not self.closed:
+                self.cond.wait()
+            if self.closed:
+                return False
+            self.chunks.append(data)
+            self.size += len(data)
+            self.cond.notify_all()
+            return True
+
+    def finish(self):
+        """Mark the end of the stream; read() returns b"" once drained"""
+        with self.cond:
+            self.eof = True
+            self.cond.notify_all()
+
+    def close(self):
+        """Stop accepting data and release a blocked producer"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def read(self, size: int = -1) -> bytes:
+        with self.cond:
+            while not self.chunks and not self.eof:
+                self.cond.wait()
+            if not self.chunks:
+                return b""
+            if size < 0:
+                data = b"".join(self.chunks)
+                self.chunks.clear()
+            else:
+                data = self.chunks.popleft()
+                if len(data) > size:
+                    self.chunks.appendleft(data[size:])
+                    data = data[:size]
+            self.size -= len(data)
+            self.cond.notify_all()
+            return data
+
+
+class FFmpegStdout:
+    """File-like view of FFmpeg's stdout, read ahead into a RingBuffer by a pump thread.
+
+    A non-zero exit is raised from read() at EOF, which makes MinIO abort the upload
+    instead of storing a truncated object.
+    """
+
+    def __init__(self, ffmpeg: FFmpegProcess):
+        self.ffmpeg = ffmpeg
+        self.buffer = RingBuffer(STREAM_BUFFER_SIZE)
+        self.pump_thread = threading.Thread(target=self._pump, daemon=True)
+        self.pump_thread.start()
+
+    def _pump(self):
+        stdout = self.ffmpeg.process.stdout
+        try:
+            while chunk := stdout.read(STREAM_READ_SIZE):
+                if not self.buffer.write(chunk):
+                    break
+        finally:
+            self.buffer.finish()
+
+    def read(self, size=-1):
+        data = self.buffer.read(size)
+        if not data:
+            self.ffmpeg.wait()
+        return data
+
+    def close(self):
+        self.buffer.close()
+        self.ffmpeg.kill()
+        self.pump_thread.join()
+        self.ffmpeg.process.stdout.close()
+
+
+def stream_ffmpeg_to_minio(task, cmd, object_name: str, content_type: str, duration=None):
+    """Run FFmpeg writing to stdout and upload its output to MinIO while it encodes"""
+    output = FFmpegStdout(FFmpegProcess(task, cmd, stdout=subprocess.PIPE, duration=duration))
+    try:
+        minio_client.put_object(
+            OUTPUT_BUCKET,
+            object_name,
+            output,
+            length=-1,
+            part_size=UPLOAD_PART_SIZE,
+            num_parallel_uploads=UPLOAD_PARALLEL_PARTS,
+            content_type=content_type
+        )
+    finally:
+        output.close()
+
+
+def upload_with_retry(file_path: Path):
+    """Upload a single output file to MinIO, retrying transient S3 errors"""
+    content_type = CONTENT_TYPES.get(file_path.suffix, DEFAULT_CONTENT_TYPE)
+    for attempt in range(UPLOAD_MAX_RETRIES):
+        try:
+            minio_client.fput_object(
+                OUTPUT_BUCKET,
+                file_path.name,
+                str(file_path),
+                content_type=content_type
+            )
+            logger.info(f"Uploaded {file_path.name}")
+            return
+        except S3Error as e:
+            if attempt < UPLOAD_MAX_RETRIES - 1:
+                logger.warning(f"Upload attempt {attempt + 1} for {file_path.name} failed, retrying: {e}")
+                continue
+            raise
+
+
+def upload_segment_batch(paths):
+    """Upload finished segments to MinIO in a single snowball request, retrying transient S3 errors"""
+    if len(paths) == 1:
+        return upload_with_retry(paths[0])
+    for attempt in range(UPLOAD_MAX_RETRIES):
+        try:
+            minio_client.upload_snowball_objects(
+                OUTPUT_BUCKET,
+                [SnowballObject(path.name, filename=str(path)) for path in paths]
+            )
+            logger.info(f"Uploaded {len(paths)} segments ({paths[0].name} .. {paths[-1].name})")
+            return
+        except S3Error as e:
+            if attempt < UPLOAD_MAX_RETRIES - 1:
+                logger.warning(f"Batch upload attempt {attempt + 1} for {len(paths)} segments failed, retrying: {e}")
+                continue
+            raise
+
+
+def segment_batches(paths):
+    """Split segments into batches of at most SNOWBALL_BATCH_BYTES (a larger segment goes alone)"""
+    batch, batch_bytes = [], 0
+    for path in sorted(paths):
+        size = path.stat().st_size
+        if batch and batch_bytes + size > SNOWBALL_BATCH_BYTES:
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(path)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def is_media_segment(path: Path) -> bool:
+    """True for .ts/.m4s media segments, which FFmpeg never rewrites once they appear"""
+    # DASH init segments are rewritten when the muxer finishes, so they wait for the end
+    return path.suffix in (".ts", ".m4s") and "_init_" not in path.name
+
+
+def encode_and_upload_segments(task, cmd, workdir: str, duration=None):
+    """Run FFmpeg and upload finished media segments in batches while it keeps encoding"""
+    ffmpeg = FFmpegProcess(task, cmd, duration=duration)
+    submitted = set()
+    pending, pending_bytes, pending_since = [], 0, None
+    futures = []
+    # The minio client's connection pool is thread-safe, so all threads share it
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        try:
+            while True:
+                # Checked before the scan so the last scan sees everything FFmpeg wrote
+                finished = ffmpeg.process.poll() is not None
+                new = [path for path in Path(workdir).iterdir() if path not in submitted and is_media_segment(path)]
+                submitted.update(new)
+                if new and not pending:
+                    pending_since = time.monotonic()
+                pending += new
+                pending_bytes += sum(path.stat().st_size for path in new)
+                if pending and (finished or pending_bytes >= SNOWBALL_BATCH_BYTES
+                                or time.monotonic() - pending_since >= SNOWBALL_MAX_WAIT):
+                    for batch in segment_batches(pending):
+                        futures.append(executor.submit(upload_segment_batch, batch))
+                    pending, pending_bytes = [], 0
+                # Stop encoding as soon as an upload has failed for good
+                for future in futures:
+                    if future.done():
+                        future.result()
+                if finished:
+                    break
+                time.sleep(SEGMENT_POLL_INTERVAL)
+            ffmpeg.wait()
+        finally:
+            ffmpeg.kill()
+        for future in futures:
+            future.result()
+
+    # Init segments and manifests go last so a visible playlist never references a missing segment
+    remaining = [path for path in Path(workdir).iterdir() if path not in submitted]
+    remaining.sort(key=lambda path: path.suffix in MANIFEST_SUFFIXES)
+    for path in remaining:
+        upload_with_retry(path)
+    return len(submitted) + len(remaining)
+
+
+def probe_args(input_name: str):
+    """Probing limits for the input; MP4/MOV only need a short probe"""
+    if Path(input_name).suffix.lower() in FAST_PROBE_SUFFIXES:
+        return FAST_PROBE_ARGS
+    return []
+
+
+def probe_source(source: str, input_args=()):
+    """Return the codec of the source's first audio stream (None if it has none) and its duration in seconds (None if unknown)"""
+    result = subprocess.run(
+        [
+            "ffprobe", "-v", "error", *INPUT_TIMEOUT_ARGS, *input_args,
+            "-select_streams", "a:0",
+            "-show_entries", "stream=codec_name:format=duration",
+            "-of", "json",
+            source
+        ],
+        capture_output=True,
+        text=True,
+        # Audio is only mapped when the probe finds it, so a failed probe must not be
+        # mistaken for a silent source; raising lets the task retry instead
+        check=True,
+        timeout=PROBE_TIMEOUT
+    )
+    info = json.loads(result.stdout)
+    streams = info.get("streams") or [{}]
+    try:
+        duration = float(info.get("format", {}).get("duration"))
+    except (TypeError, ValueError):
+        duration = None
+    return streams[0].get("codec_name"), duration
+
+
+def audio_codec_args(source_codec):
+    """FFmpeg audio options; AAC sources are copied since re-encoding them gains nothing"""
+    if source_codec == "aac":
+        return ["-c:a", "copy"]
+    return ["-c:a", "aac", "-b:a", "128k"]
+
+
+# Seconds an encoder probe may take; a wedged GPU driver can hang FFmpeg indefinitely,
+# which would stall worker startup
+ENCODER_PROBE_TIMEOUT = 30
+
+
+def encoder_works(encoder: str, input_args=(), video_filter=None) -> bool:
+    """Check an FFmpeg encoder (optionally behind a filter chain) by encoding a single test frame"""
+    try:
+        result = subprocess.run(
+            [
+                "ffmpeg", "-hide_banner", "-v", "error",
+                *input_args,
+                "-f", "lavfi", "-i", "color=size=256x256:duration=0.1",
+                "-frames:v", "1",
+                *(["-vf", video_filter] if video_filter else []),
+                "-c:v", encoder,
+                "-f", "null", "-"
+            ],
+            capture_output=True,
+            timeout=ENCODER_PROBE_TIMEOUT
+        )
+    except subprocess.TimeoutExpired:
+        logger.warning(f"Test encode with {encoder} timed out, treating it as unavailable")
+        return False
+    return result.returncode == 0
+
+
+# NUMA node this worker's FFmpeg runs are confined to (CPUs and memory), e.g. one worker
+# per socket on multi-socket hosts so encoders never reach across the interconnect
+NUMA_NODE = os.getenv("NUMA_NODE")
+
+
+def numa_prefix():
+    """numactl launcher pinning FFmpeg to NUMA_NODE, or nothing when unset or unavailable"""
+    if NUMA_NODE is None:
+        return []
+    if not shutil.which("numactl"):
+        logger.warning(f"NUMA_NODE={NUMA_NODE} is set but numactl is not installed; not pinning")
+        return []
+    # x264 sizes its thread pool from the CPUs it is allowed on, so -threads 0 follows the pinning
+    return ["numactl", f"--cpunodebind={NUMA_NODE}", f"--membind={NUMA_NODE}"]
+
+
+# DRM render node used for VAAPI encoding on Intel/AMD GPUs
+VAAPI_DEVICE = "/dev/dri/renderD128"
+
+# Test runs for the hardware encoders, in order of preference. VAAPI is tested through
+# scale_vaapi because it is only ever used with frames kept on the GPU.
+HW_ENCODER_TESTS = {
+    "h264_nvenc": {},
+    "h264_vaapi": {
+        "input_args": ["-init_hw_device", f"vaapi=va:{VAAPI_DEVICE}", "-filter_hw_device", "va"],
+        "video_filter": "format=nv12,hwupload,scale_vaapi=w=128:h=128",
+    },
+    "h264_qsv": {},
+}
+
+
+@functools.lru_cache(maxsize=1)
+def detect_video_encoder() -> str:
+    """Pick the fastest H.264 encoder usable on this host, falling back to libx264"""
+    try:
+        encoders = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True,
+            timeout=ENCODER_PROBE_TIMEOUT
+        ).stdout
+        # Stock FFmpeg builds list hardware encoders even without the hardware,
+        # so each candidate also has to pass a test encode
+        for encoder, test in HW_ENCODER_TESTS.items():
+            if encoder == "h264_vaapi" and not os.path.exists(VAAPI_DEVICE):
+                continue
+            if encoder in encoders and encoder_works(encoder, **test):
+                return encoder
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning(f"FFmpeg encoder probe failed: {e}")
+    return "libx264"
+
+
+@functools.lru_cache(maxsize=1)
+def detect_gpu_scaling() -> bool:
+    """Check that frames can stay in GPU memory from decode through scaling to the encoder"""
+    if detect_video_encoder() == "h264_vaapi":
+        # Already covered by the scale_vaapi test run during encoder detection
+        return True
+    # scale_cuda depends on how FFmpeg was built, independently of NVENC support
+    return detect_video_encoder() == "h264_nvenc" and encoder_works(
+        "h264_nvenc",
+        input_args=["-init_hw_device", "cuda=gpu", "-filter_hw_device", "gpu"],
+        video_filter="format=nv12,hwupload,scale_cuda=128:128"
+    )
+
+
+@worker_init.connect
+def detect_encoders(**kwargs):
+    """Run the encoder probes once in the worker's main process, before the pool forks"""
+    # Detection forks several FFmpeg test encodes, so it's cached rather than repeated per
+    # task, and it happens here rather than at import so the API (which imports this
+    # module to enqueue tasks) never runs it
+    logger.info(f"Video encoder: {detect_video_encoder()}, GPU scaling: {detect_gpu_scaling()}")
+
+
+# FFmpeg errors from hardware frames, devices and the conversions between them and
+# system memory (e.g. "Impossible to convert between the formats", "No hw_frames_ctx")
+HW_ERROR_RE = re.compile(
+    r"hwaccel|hw_?frames|hwupload|hwdownload|hardware|cuda|cuvid|nvdec|vaapi|va-api|"
+    r"impossible to convert between the formats|error reinitializing filters",
+    re.IGNORECASE
+)
+
+
+def is_gpu_decode_failure(error: subprocess.CalledProcessError) -> bool:
+    """Whether a failed run looks like the GPU decode/scale path rejecting the source"""
+    # Such failures happen while the filter graph is set up, before the first frame is
+    # encoded, or name the hardware frames that couldn't be converted. Anything else
+    # (network, storage, a broken source) is left to the task's retry.
+    return not getattr(error, "frames", 0) or bool(HW_ERROR_RE.search(error.stderr or ""))
+
+
+def hwaccel_input_args(gpu_decode: bool = True):
+    """FFmpeg input options; with GPU decode, frames are decoded straight into GPU memory"""
+    encoder = detect_video_encoder()
+    if encoder == "h264_vaapi":
+        if gpu_decode:
+            # Decoded frames are already VAAPI surfaces, so no format=nv12,hwupload round trip
+            return [
+                "-hwaccel", "vaapi",
+                "-hwaccel_device", VAAPI_DEVICE,
+                "-hwaccel_output_format", "vaapi"
+            ]
+        # Software-decoded frames still have to be uploaded for the VAAPI encoder
+        return ["-init_hw_device", f"vaapi=va:{VAAPI_DEVICE}", "-filter_hw_device", "va"]
+    if gpu_decode and detect_gpu_scaling():
+        return ["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"]
+    return []
+
+
+def scale_filter(resolution: str, gpu_decode: bool = True) -> str:
+    """Scale filter matching where the decoded frames live"""
+    encoder = detect_video_encoder()
+    if encoder == "h264_vaapi":
+        if gpu_decode:
+            width, height = resolution.split(":")
+            return f"scale_vaapi=w={width}:h={height}"
+        return f"scale={resolution},format=nv12,hwupload"
+    if gpu_decode and detect_gpu_scaling():
+        return f"scale_cuda={resolution}"
+    return f"scale={resolution}"
+
+
+def video_codec_args(resolution: str, preset=None, maxrate=None):
+    """FFmpeg video encoder options for the detected encoder and target resolution, capped at maxrate kbit/s if given"""
+    encoder = detect_video_encoder()
+    cap = ["-maxrate", f"{maxrate}k", "-bufsize", f"{2 * maxrate}k"] if maxrate else []
+    if encoder == "h264_nvenc":
+        return ["-c:v", "h264_nvenc", "-preset", "p4", "-tune", "hq", "-rc", "vbr", "-cq", "23", "-b:v", "0", *cap]
+    # VAAPI's constant QP and QSV's ICQ ignore -maxrate, so capped renditions switch
+    # those encoders to VBR, averaging three quarters of the cap
+    if encoder == "h264_vaapi":
+        if maxrate:
+            return ["-c:v", "h264_vaapi", "-rc_mode", "VBR", "-b:v", f"{maxrate * 3 // 4}k", *cap]
+        return ["-c:v", "h264_vaapi", "-rc_mode", "CQP", "-qp", "23"]
+    if encoder == "h264_qsv":
+        if maxrate:
+            return ["-c:v", "h264_qsv", "-preset", "medium", "-b:v", f"{maxrate * 3 // 4}k", *cap]
+        return ["-c:v", "h264_qsv", "-preset", "medium", "-global_quality", "23"]
+    if not preset:
+        # medium only pays off at large sizes; small renditions get a faster preset
+        height = int(resolution.split(":")[1])
+        if height <= 480:
+            preset = "veryfast"
+        elif height <= 720:
+            preset = "fast"
+        else:
+            preset = "medium"
+    return ["-c:v", "libx264", "-preset", preset, "-crf", "23", *cap]
+
+
+# Seconds between keyframes in HLS/DASH output; divides the 10 second segment length
+KEYFRAME_INTERVAL = 2
+
+# Bitrate caps (kbit/s) by rendition height, so CRF can't overshoot a ladder rung's budget
+LADDER_MAXRATES = {
+    2160: 16000,
+    1440: 9000,
+    1080: 4300,
+    720: 2300,
+    480: 1200,
+    360: 750,
+    240: 400,
+}
+
+
+def rendition_args(resolution: str, index: int, capped: bool, preset=None):
+    """Video encoder options scoped to the index-th video stream of an output (-crf -> -crf:v:1)"""
+    maxrate = LADDER_MAXRATES[int(resolution.split(":")[1])] if capped else None
+    args = video_codec_args(resolution, preset, maxrate) + [
+        # Keyframes on a fixed time grid instead of at scene cuts, so segments split on
+        # the same instants in every rendition and players can switch between them cleanly
+        "-force_key_frames", f"expr:gte(t,n_forced*{KEYFRAME_INTERVAL})",
+        "-sc_threshold", "0",
+    ]
+    return [
+        (f"{arg}:{index}" if arg.endswith(":v") else f"{arg}:v:{index}") if arg.startswith("-") else arg
+        for arg in args
+    ]
+
+
+def ladder_filter(resolutions, copies: int, gpu_decode: bool = True) -> str:
+    """filter_complex graph that decodes once and fans out to every rendition, labelled [v<rendition>_<copy>]"""
+    chains = []
+    if len(resolutions) > 1:
+        chains.append(f"[0:v]split={len(resolutions)}" + "".join(f"[s{i}]" for i in range(len(resolutions))))
+    for i, resolution in enumerate(resolutions):
+        source = f"[s{i}]" if len(resolutions) > 1 else "[0:v]"
+        chain = f"{source}{scale_filter(resolution, gpu_decode)}"
+        if copies > 1:
+            # Each packaging gets its own copy of the scaled frames
+            chain += f",split={copies}"
+        chains.append(chain + "".join(f"[v{i}_{c}]" for c in range(copies)))
+    return ";".join(chains)
+
+
+def hls_output_args(workdir: str, stem: str, renditions: int = 1, has_audio: bool = False):
+    """FFmpeg output options for an HLS playlist and its .ts segments"""
+    args = [
+        "-f", "hls",
+        "-hls_time", "10",
+        "-hls_playlist_type", "vod",
+        # Segments are written as .tmp and renamed when complete, so uploads never see a partial one
+        "-hls_flags", "temp_file",
+    ]
+    if renditions == 1:
+        return args + [
+            "-hls_segment_filename", os.path.join(workdir, f"{stem}_%03d.ts"),
+            "-y",
+            os.path.join(workdir, f"{stem}.m3u8")
+        ]
+    # One variant playlist per rendition; the master playlist takes the usual output name.
+    # Audio is packaged once as a rendition group shared by every variant.
+    stream_map = [f"v:{i},agroup:audio" if has_audio else f"v:{i}" for i in range(renditions)]
+    if has_audio:
+        stream_map.append("a:0,agroup:audio")
+    return args + [
+        "-var_stream_map", " ".join(stream_map),
+        "-master_pl_name", f"{stem}.m3u8",
+        "-hls_segment_filename", os.path.join(workdir, f"{stem}_%v_%03d.ts"),
+        "-y",
+        os.path.join(workdir, f"{stem}_%v.m3u8")
+    ]
+
+
+def dash_output_args(workdir: str, stem: str, renditions: int = 1, has_audio: bool = False):
+    """FFmpeg output options for a DASH manifest and its .m4s segments (written next to the manifest)"""
+    args = [
+        "-f", "dash",
+        "-seg_duration", "10",
+        "-use_template", "1",
+        "-use_timeline", "1",
+        "-init_seg_name", f"{stem}_init_$RepresentationID$.m4s",
+        "-media_seg_name", f"{stem}_chunk_$RepresentationID$_$Number$.m4s",
+    ]
+    if renditions > 1:
+        # All renditions in one switchable video set, audio in its own
+        args += ["-adaptation_sets", "id=0,streams=v id=1,streams=a" if has_audio else "id=0,streams=v"]
+    return args + [
+        "-y",
+        os.path.join(workdir, f"{stem}.mpd")
+    ]
+
+
+PACKAGERS = {
+    "hls": hls_output_args,
+    "dash": dash_output_args,
+}
+
+
+def transcode_command(input_url: str, input_name: str, workdir: str, stem: str, resolutions,
+                      format: str, preset, audio_codec, gpu_decode: bool):
+    """Build the FFmpeg command for the requested format"""
+    audio_args = audio_codec_args(audio_codec)
+    input_args = [
+        *hwaccel_input_args(gpu_decode), *INPUT_RECONNECT_ARGS, *INPUT_TIMEOUT_ARGS,
+        *DEMUX_FLAGS, *probe_args(input_name),
+        "-i", input_url
+    ]
+    if format == "mp4":
+        # Fragmented MP4 needs no seek back to the header (unlike +faststart),
+        # so it can be written to a pipe and uploaded while encoding. Only the first video
+        # and (if present) first audio stream are kept, as in the HLS/DASH ladders; FFmpeg's
+        # default selection could pick another audio track or pass through data streams.
+        return [
+            *numa_prefix(), "ffmpeg", *PROGRESS_ARGS, "-filter_threads", "0", *input_args,
+            "-map", "0:v:0", "-map", "0:a:0?",
+            "-vf", scale_filter(resolutions[0], gpu_decode),
+            *video_codec_args(resolutions[0], preset),
+            "-threads", "0",
+            *audio_args,
+            "-movflags", "frag_keyframe+empty_moov",
+            "-f", "mp4",
+            "pipe:1"
+        ]
+    # "hls", "dash" or "hls+dash". The source is decoded once and the frames fanned
+    # out to every rendition of every packaging.
+    packagings = format.split("+")
+    capped = len(resolutions) > 1
+    cmd = [
+        *numa_prefix(), "ffmpeg", *PROGRESS_ARGS, "-filter_complex_threads", "0", *input_args,
+        "-filter_complex", ladder_filter(resolutions, len(packagings), gpu_decode)
+    ]
+    for p, packaging in enumerate(packagings):
+        for i, rendition in enumerate(resolutions):
+            cmd += ["-map", f"[v{i}_{p}]", *rendition_args(rendition, i, capped, preset)]
+        cmd += ["-threads", "0"]
+        if audio_codec:
+            cmd += ["-map", "0:a:0", *audio_args]
+        cmd += PACKAGERS[packaging](workdir, stem, len(resolutions), audio_codec is not None)
+    return cmd
+
+
+def run_transcode(task, cmd, format: str, workdir: str, output_name: str, duration=None):
+    """Run FFmpeg and upload its output to MinIO"""
+    if format != "mp4":
+        # Segments are uploaded as FFmpeg finishes them, overlapping upload with encoding
+        uploaded = encode_and_upload_segments(task, cmd, workdir, duration)
+        logger.info(f"Task {task.request.id}: Uploaded {uploaded} files")
+    else:
+        # A streamed upload can't be replayed, so failures fall through to the caller
+        stream_ffmpeg_to_minio(task, cmd, output_name, CONTENT_TYPES[".mp4"], duration)
+        logger.info(f"Task {task.request.id}: Upload complete")
+
+
+# Per-task work directories are created under the system temp dir with this prefix
+WORKDIR_PREFIX = "xcode_"
+
+
+@worker_init.connect
+def sweep_stale_workdirs(**kwargs):
+    """Remove work directories left behind by tasks killed before their cleanup could run"""
+    # A task hitting the hard time limit is killed outright, skipping its finally block;
+    # anything older than that limit can't belong to a running task
+    cutoff = time.time() - TASK_TIME_LIMIT
+    for path in Path(tempfile.gettempdir()).glob(f"{WORKDIR_PREFIX}*"):
+        try:
+            if path.is_dir() and path.stat().st_mtime < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+                logger.info(f"Removed stale work directory {path}")
+        except OSError:
+            continue
+
+
 @celery_app.task(bind=True, max_retries=3)
-def transcode_video_task(self, input_name: str, output_name: str, resolution: str, format: str = "mp4"):
+def transcode_video_task(self, input_name: str, output_name: str, resolution, format: str = "mp4", preset=None):
     """Celery task to transcode video using FFmpeg"""
+    # Every file the task writes lives here, so one rmtree cleans up after success or failure
+    workdir = tempfile.mkdtemp(prefix=f"{WORKDIR_PREFIX}{self.request.id}_")
     try:
-        # Download from MinIO
-        input_path = f"/tmp/{input_name}"
+        # FFmpeg reads the source straight from MinIO, so decoding starts with the first
+        # bytes instead of after a full download. A presigned URL is used rather than
+        # pipe:0 because MP4s with the moov atom at the end need seeking, which FFmpeg's
+        # HTTP reader does with range requests.
+        input_url = minio_client.presigned_get_object(INPUT_BUCKET, input_name, expires=INPUT_URL_EXPIRY)
+        logger.info(f"Task {self.request.id}: Streaming input {input_name}")
         
-        logger.info(f"Task {self.request.id}: Downloading {input_name}")
-        minio_client.fget_object(INPUT_BUCKET, input_name, input_path)
+        # A single resolution or an ABR ladder (HLS/DASH only)
+        resolutions = [resolution] if isinstance(resolution, str) else list(resolution)
+        audio_codec, duration = probe_source(input_url, probe_args(input_name))
         
-        # Build FFmpeg command based on format
-        if format == "hls":
-            output_path = f"/tmp/{Path(output_name).stem}.m3u8"
-            cmd = [
-                "ffmpeg", "-i", input_path,
-                "-vf", f"scale={resolution}",
-                "-c:v", "libx264",
-                "-preset", "medium",
-                "-crf", "23",
-                "-c:a", "aac",
-                "-b:a", "128k",
-                "-hls_time", "10",
-                "-hls_playlist_type", "vod",
-                "-hls_segment_filename", f"/tmp/{Path(output_name).stem}_%03d.ts",
-                "-y",
-                output_path
-            ]
-        elif format == "dash":
-            output_path = f"/tmp/{Path(output_name).stem}.mpd"
-            cmd = [
-                "ffmpeg", "-i", input_path,
-                "-vf", f"scale={resolution}",
-                "-c:v", "libx264",
-                "-preset", "medium",
-                "-crf", "23",
-                "-c:a", "aac",
-                "-b:a", "128k",
-                "-f", "dash",
-                "-seg_duration", "10",
-                "-use_template", "1",
-                "-use_timeline", "1",
-                "-init_seg_name", f"{Path(output_name).stem}_init_$RepresentationID$.m4s",
-                "-media_seg_name", f"{Path(output_name).stem}_chunk_$RepresentationID$_$Number$.m4s",
-                "-y",
-                output_path
-            ]
-        else:
-            output_path = f"/tmp/{output_name}"
-            cmd = [
-                "ffmpeg", "-i", input_path,
-                "-vf", f"scale={resolution}",
-                "-c:v", "libx264",
-                "-preset", "medium",
-                "-crf", "23",
-                "-c:a", "aac",
-                "-b:a", "128k",
-                "-movflags", "+faststart",
-                "-y",
-                output_path
-            ]
+        stem = Path(output_name).stem
+        gpu_decode = detect_gpu_scaling()
+        cmd = transcode_command(
+            input_url, input_name, workdir, stem, resolutions, format, preset, audio_codec, gpu_decode
+        )
         
         logger.info(f"Task {self.request.id}: Starting transcoding {format}")
         
         # Update task state to show progress
         self.update_state(state='PROGRESS', meta={'status': 'transcoding'})
         
-        process = subprocess.run(cmd, check=True, capture_output=True)
-        
-        # Upload files
-        max_retries = 3
+        try:
+            run_transcode(self, cmd, format, workdir, output_name, duration)
+        except subprocess.CalledProcessError as e:
+            if not gpu_decode or not is_gpu_decode_failure(e):
+                raise
+            # Codecs the GPU decoder can't handle (ProRes, MPEG-4 Part 2, 4:2:2 H.264, ...)
+            # are decoded in software, leaving frames in system memory where the GPU scaler
+            # fails on them. Such sources are redone with CPU decode and scaling.
+            last_line = e.stderr.splitlines()[-1] if e.stderr else e
+            logger.warning(f"Task {self.request.id}: GPU decode failed ({last_line}), retrying with CPU decode")
+            shutil.rmtree(workdir, ignore_errors=True)
+            os.mkdir(workdir)
+            cmd = transcode_command(
+                input_url, input_name, workdir, stem, resolutions, format, preset, audio_codec, False
+            )
+            run_transcode(self, cmd, format, workdir, output_name, duration)
         
-        if format in ["hls", "dash"]:
-            output_dir = Path(output_path).parent
-            pattern = f"{Path(output_name).stem}*"
-            files_to_upload = list(output_dir.glob(pattern))
-            
-            logger.info(f"Task {self.request.id}: Uploading {len(files_to_upload)} files")
-            
-            for file_path in files_to_upload:
-                for attempt in range(max_retries):
-                    try:
-                        content_type = "application/vnd.apple.mpegurl" if file_path.suffix == ".m3u8" else \
-                                     "application/dash+xml" if file_path.suffix == ".mpd" else \
-                                     "video/mp2t" if file_path.suffix == ".ts" else \
-                                     "application/octet-stream"
-                        
-                        minio_client.fput_object(
-                            OUTPUT_BUCKET,
-                            file_path.name,
-                            str(file_path),
-                            content_type=content_type
-                        )
-                        logger.info(f"Task {self.request.id}: Uploaded {file_path.name}")
-                        break
-                    except S3Error as e:
-                        if attempt < max_retries - 1:
-                            logger.warning(f"Upload attempt {attempt + 1} failed, retrying: {e}")
-                            continue
-                        else:
-                            raise
-            
-            # Cleanup
-            for file_path in files_to_upload:
-                if file_path.exists():
-                    os.remove(file_path)
-        else:
-            for attempt in range(max_retries):
-                try:
-                    minio_client.fput_object(
-                        OUTPUT_BUCKET,
-                        output_name,
-                        output_path,
-                        content_type="video/mp4"
-                    )
-                    logger.info(f"Task {self.request.id}: Upload complete")
-                    break
-                except S3Error as e:
-                    if attempt < max_retries - 1:
-                        logger.warning(f"Upload attempt {attempt + 1} failed, retrying: {e}")
-                        continue
-                    else:
-                        raise
-            
-            if os.path.exists(output_path):
-                os.remove(output_path)
-        
-        # Cleanup input
-        os.remove(input_path)
-        
-        return {
+        result = {
             'status': 'completed',
             'output_name': output_name,
             'format': format
         }
+        if format == "hls+dash":
+            result['outputs'] = [f"{stem}.m3u8", f"{stem}.mpd"]
+        if len(resolutions) > 1:
+            result['resolutions'] = resolutions
+        return result
         
     except subprocess.CalledProcessError as e:
-        logger.error(f"Task {self.request.id}: FFmpeg error: {e.stderr.decode() if e.stderr else str(e)}")
-        # Cleanup on error
-        if 'input_path' in locals() and os.path.exists(input_path):
-            os.remove(input_path)
-        if 'output_path' in locals() and os.path.exists(output_path):
-            os.remove(output_path)
-        
+        logger.error(f"Task {self.request.id}: FFmpeg error: {e.stderr or str(e)}")
         # Retry on failure
         raise self.retry(exc=e, countdown=60)  # Retry after 60 seconds
         
     except Exception as e:
         logger.error(f"Task {self.request.id}: Error: {e}")
         raise self.retry(exc=e, countdown=60)
+    
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -7,22 +7,32 @@ MONGO_URL = os.getenv(
     "mongodb://localhost:27017/motor"
 )
 
-# Global Mongo client (lazy singleton)
+# Global Mongo client and products collection (lazy singletons)
 _client: AsyncIOMotorClient | None = None
+_collection = None
 
 def get_client() -> AsyncIOMotorClient:
     """
     Lazily create and return a global Motor client.
-    Motor manages an internal connection pool automatically.
+    The pool keeps a few warm connections (primed by the startup ping)
+    and drops ones idle for more than 5 minutes.
     """
     global _client
     if _client is None:
-        _client = AsyncIOMotorClient(MONGO_URL)
+        _client = AsyncIOMotorClient(
+            MONGO_URL,
+            maxPoolSize=200,
+            minPoolSize=10,
+            maxIdleTimeMS=300_000,
+            serverSelectionTimeoutMS=5000,
+        )
     return _client
 
 def get_collection():
     """
-    Returns the products collection.
+    Returns the products collection, creating the handle once.
     """
-    client = get_client()
-    return client["motor"]["products"]
+    global _collection
+    if _collection is None:
+        _collection = get_client()["motor"]["products"]
+    return _collection
@@ -0,0 +1,28 @@
+import os
+import certifi
+import urllib3
+
+
+def create_http_client() -> urllib3.PoolManager:
+    """
+    HTTP pool for a MinIO client, shared by the API and the worker.
+    minio-py's default caps the pool at 10 connections, which concurrent streams,
+    downloads and parallel segment/part uploads would queue on; with 64, every
+    thread keeps its own connection (reused through HTTP keep-alive).
+    Timeouts, CA bundle and retries mirror minio-py's defaults. The long timeouts
+    matter: urllib3 leaves the connect timeout on the socket while the request body
+    is sent, so a short one would cut off large part uploads mid-body.
+    """
+    return urllib3.PoolManager(
+        num_pools=10,
+        maxsize=64,
+        block=False,
+        timeout=urllib3.Timeout(connect=300, read=300),
+        cert_reqs="CERT_REQUIRED",
+        ca_certs=os.getenv("SSL_CERT_FILE") or certifi.where(),
+        retries=urllib3.Retry(
+            total=5,
+            backoff_factor=0.2,
+            status_forcelist=[500, 502, 503, 504]
+        )
+    )
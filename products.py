@@ -1,7 +1,8 @@
-from fastapi import APIRouter, HTTPException, Query
+from fastapi import APIRouter, HTTPException, Query, Response
 from pydantic import BaseModel
 from typing import Optional, List
 from bson import ObjectId
+from bson.errors import InvalidId
 from db import get_collection
 
 # ---- Schemas ----
@@ -15,7 +16,9 @@ class ProductOut(ProductIn):
     id: str
 
 def to_product_out(doc) -> ProductOut:
-    return ProductOut(
+    # Documents come from our own collection, so skip per-field validation;
+    # the response_model serializer still makes its single pass over the output
+    return ProductOut.model_construct(
         id=str(doc["_id"]),
         name=doc.get("name", "Unknown"),
         price=str(doc.get("price", "0.0")),
@@ -23,20 +26,34 @@ def to_product_out(doc) -> ProductOut:
         image=doc.get("image"),
     )
 
+# Only the fields ProductOut needs; anything else stored on a document stays on the server
+PRODUCT_PROJECTION = {"name": 1, "price": 1, "description": 1, "image": 1}
+
 router = APIRouter(prefix="/products", tags=["products"])
 
 @router.get("", response_model=List[ProductOut])
 @router.get("/", response_model=List[ProductOut])
 async def list_products(
+    response: Response,
     limit: int = Query(50, ge=1, le=200),
-    skip: int = Query(0, ge=0),
+    after: Optional[str] = Query(None, description="Return products after this id (the X-Next-Cursor of the previous page)"),
+    skip: int = Query(0, ge=0, deprecated=True),
 ):
+    # Keyset pagination: an index seek on _id instead of Mongo walking and discarding `skip` docs
+    try:
+        query = {"_id": {"$gt": ObjectId(after)}} if after else {}
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
     col = get_collection()
     try:
-        items: List[ProductOut] = []
-        cursor = col.find({}, skip=skip, limit=limit)
-        async for doc in cursor:
-            items.append(to_product_out(doc))
+        # One batch covers the whole page, so it comes back in a single round trip
+        cursor = col.find(query, PRODUCT_PROJECTION, skip=skip, limit=limit).sort("_id", 1).batch_size(limit)
+        # A single await for the page instead of one per document
+        docs = await cursor.to_list(length=limit)
+        items = [to_product_out(doc) for doc in docs]
+        if len(items) == limit:
+            response.headers["X-Next-Cursor"] = items[-1].id
         return items
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
@@ -1,12 +1,15 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException, Body
+from fastapi import APIRouter, UploadFile, File, HTTPException, Body, Request
 from fastapi.responses import StreamingResponse
-from pydantic import BaseModel, Field
-from typing import Literal, Optional
+from pydantic import BaseModel, Field, model_validator
+from typing import List, Literal, Optional, Union
 from minio import Minio
 from minio.error import S3Error
+from minio_http import create_http_client
 import subprocess
 import os
 import uuid
+import time
+import re
 from pathlib import Path
 import logging
 
@@ -29,18 +32,57 @@ def init_celery():
         logger.warning(f"⚠️ Celery not available: {e}")
 
 
+Resolution = Literal[
+    "3840:2160",  # 4K UHD
+    "2560:1440",  # 2K QHD
+    "1920:1080",  # 1080p Full HD
+    "1280:720",   # 720p HD
+    "854:480",    # 480p SD
+    "640:360",    # 360p
+    "426:240"     # 240p
+]
+
+# Named ABR ladders, highest rendition first
+LADDERS = {
+    "standard": ["1920:1080", "1280:720", "854:480", "640:360"],
+}
+
+
 class TranscodeRequest(BaseModel):
-    resolution: Literal[
-        "3840:2160",  # 4K UHD
-        "2560:1440",  # 2K QHD
-        "1920:1080",  # 1080p Full HD
-        "1280:720",   # 720p HD
-        "854:480",    # 480p SD
-        "640:360",    # 360p
-        "426:240"     # 240p
-    ] = "1280:720"
-    format: Literal["dash", "hls", "mp4"] = "mp4"
+    # A single resolution, or an ABR ladder given as a list or by name
+    resolution: Union[Resolution, List[Resolution], Literal["standard"]] = "1280:720"
+    # "hls+dash" packages both from a single decode and scale
+    format: Literal["dash", "hls", "hls+dash", "mp4"] = "mp4"
+    # x264 speed/quality trade-off for CPU encodes; by default it is picked from the
+    # output height. Hardware encoders ignore it.
+    preset: Optional[Literal["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow"]] = None
+
+    def resolutions(self) -> List[str]:
+        """Every resolution to encode, with named ladders expanded"""
+        if isinstance(self.resolution, list):
+            return list(dict.fromkeys(self.resolution))
+        return LADDERS.get(self.resolution, [self.resolution])
+
+    @model_validator(mode="after")
+    def check_ladder(self):
+        if not self.resolutions():
+            raise ValueError("resolution list must not be empty")
+        if len(self.resolutions()) > 1 and self.format == "mp4":
+            raise ValueError("a resolution ladder needs format hls, dash or hls+dash")
+        return self
+
+
+def get_output_name(file_id: str, format: str) -> str:
+    """Name of the transcoded object (the playlist for HLS, the manifest for DASH)"""
+    if format in ("hls", "hls+dash"):
+        return f"{file_id}_transcoded.m3u8"
+    elif format == "dash":
+        return f"{file_id}_transcoded.mpd"
+    return f"{file_id}_transcoded.mp4"
+
 
+# Routes are plain def: MinIO and Celery calls block, so FastAPI runs them in its
+# threadpool instead of stalling the event loop for every other request
 router = APIRouter(prefix="/videos", tags=["videos"])
 
 # MinIO Configuration
@@ -53,12 +95,26 @@ MINIO_SECURE = os.getenv("MINIO_SECURE", "false").lower() == "true"
 INPUT_BUCKET = "videobucket"
 OUTPUT_BUCKET = "videobucket"
 
+# Uploads below the threshold go up in a single PUT; larger ones are split into parts
+# that are sent in parallel, hiding the per-request round trip
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+UPLOAD_PART_SIZE = 16 * 1024 * 1024
+UPLOAD_PARALLEL_PARTS = 8
+
+# Single byte range from a Range header: "bytes=500-999", "bytes=500-" or "bytes=-500"
+RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)")
+
+# Chunk size when proxying objects to clients; bigger chunks mean fewer trips through the
+# event loop per byte
+STREAM_CHUNK_SIZE = 1024 * 1024
+
 # Initialize MinIO client
 minio_client = Minio(
     MINIO_ENDPOINT,
     access_key=MINIO_ACCESS_KEY,
     secret_key=MINIO_SECRET_KEY,
-    secure=MINIO_SECURE
+    secure=MINIO_SECURE,
+    http_client=create_http_client()
 )
 
 
@@ -67,23 +123,35 @@ async def init_minio_buckets():
     try:
         import json
         
-        for bucket in [INPUT_BUCKET, OUTPUT_BUCKET]:
+        # Input and output may be the same bucket; each is only set up once
+        for bucket in sorted({INPUT_BUCKET, OUTPUT_BUCKET}):
+            created = False
             if not minio_client.bucket_exists(bucket):
                 minio_client.make_bucket(bucket)
                 logger.info(f"Created bucket: {bucket}")
+                created = True
             
-            # Set bucket policy to allow public read access
+            # Set bucket policy to allow public read access. Written in the normalized
+            # form MinIO returns it in (lists everywhere), so an unchanged policy compares equal.
             policy = {
                 "Version": "2012-10-17",
                 "Statement": [
                     {
                         "Effect": "Allow",
-                        "Principal": {"AWS": "*"},
+                        "Principal": {"AWS": ["*"]},
                         "Action": ["s3:GetObject"],
                         "Resource": [f"arn:aws:s3:::{bucket}/*"]
                     }
                 ]
             }
+            if not created:
+                try:
+                    if json.loads(minio_client.get_bucket_policy(bucket)) == policy:
+                        logger.info(f"Public read policy already set for bucket: {bucket}")
+                        continue
+                except S3Error as e:
+                    if e.code != "NoSuchBucketPolicy":
+                        raise
             minio_client.set_bucket_policy(bucket, json.dumps(policy))
             logger.info(f"Set public read policy for bucket: {bucket}")
             
@@ -96,8 +164,24 @@ async def init_minio_buckets():
 # We removed the duplicate function from here to avoid naming conflicts
 
 
+def find_input_object(file_id: str) -> Optional[str]:
+    """Name of the uploaded source video for file_id, or None if there isn't one"""
+    # Uploads are named {file_id}{ext} and almost always .mp4, which a single HEAD confirms;
+    # only other extensions fall back to a LIST
+    try:
+        minio_client.stat_object(INPUT_BUCKET, f"{file_id}.mp4")
+        return f"{file_id}.mp4"
+    except S3Error as e:
+        if e.code != "NoSuchKey":
+            raise
+    # The "." keeps {file_id}_transcoded outputs out of the listing
+    for obj in minio_client.list_objects(INPUT_BUCKET, prefix=f"{file_id}."):
+        return obj.object_name
+    return None
+
+
 @router.post("/upload")
-async def upload_video(file: UploadFile = File(...)):
+def upload_video(file: UploadFile = File(...)):
     """Upload video to MinIO storage"""
     try:
         # Validate file type
@@ -108,13 +192,17 @@ async def upload_video(file: UploadFile = File(...)):
         file_ext = Path(file.filename).suffix or ".mp4"
         object_name = f"{file_id}{file_ext}"
         
-        # Upload to MinIO
+        # Upload to MinIO. The upload is already spooled, so its size is known and
+        # small files can skip multipart; a part size of the whole file means one PUT.
+        length = file.size if file.size is not None else -1
+        part_size = MULTIPART_THRESHOLD if 0 <= length < MULTIPART_THRESHOLD else UPLOAD_PART_SIZE
         minio_client.put_object(
             INPUT_BUCKET,
             object_name,
             file.file,
-            length=-1,
-            part_size=10*1024*1024,
+            length=length,
+            part_size=part_size,
+            num_parallel_uploads=UPLOAD_PARALLEL_PARTS,
             content_type=file.content_type
         )
         
@@ -133,33 +221,25 @@ async def upload_video(file: UploadFile = File(...)):
 
 
 @router.post("/transcode/{file_id}")
-async def transcode_video(
+def transcode_video(
     file_id: str,
     request: TranscodeRequest = TranscodeRequest()
 ):
     """Start video transcoding job with specified resolution and format (using Celery worker)"""
     try:
-        input_name = None
-        # Find the file with this ID
-        objects = minio_client.list_objects(INPUT_BUCKET, prefix=file_id)
-        for obj in objects:
-            input_name = obj.object_name
-            break
-        
+        input_name = find_input_object(file_id)
         if not input_name:
             raise HTTPException(status_code=404, detail="Video file not found")
         
         # Set appropriate file extension based on format
-        if request.format == "hls":
-            output_name = f"{file_id}_transcoded.m3u8"
-        elif request.format == "dash":
-            output_name = f"{file_id}_transcoded.mpd"
-        else:
-            output_name = f"{file_id}_transcoded.mp4"
+        output_name = get_output_name(file_id, request.format)
         
         # Send task to Celery worker
         if CELERY_AVAILABLE:
-            task = transcode_video_task.delay(input_name, output_name, request.resolution, request.format)
+            # One invocation encodes the whole ladder from a single decode
+            resolutions = request.resolutions()
+            resolution = resolutions[0] if len(resolutions) == 1 else resolutions
+            task = transcode_video_task.delay(input_name, output_name, resolution, request.format, request.preset)
             task_id = task.id
         else:
             raise HTTPException(status_code=503, detail="Worker service not available")
@@ -171,6 +251,7 @@ async def transcode_video(
             "output_name": output_name,
             "resolution": request.resolution,
             "format": request.format,
+            "preset": request.preset,
             "status": "processing"
         }
     except HTTPException:
@@ -180,9 +261,45 @@ async def transcode_video(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def stream_object(response):
+    """Yield a get_object body, returning its connection to the pool even if the client disconnects"""
+    try:
+        yield from response.stream(STREAM_CHUNK_SIZE)
+    finally:
+        response.close()
+        response.release_conn()
+
+
+def parse_range(header: Optional[str], size: int):
+    """(start, end) of the requested byte range, inclusive, or None to send the whole object"""
+    # Malformed and multi-range headers are ignored, which HTTP allows
+    match = RANGE_RE.fullmatch(header.strip()) if header else None
+    if not match or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if start and end and int(end) < int(start):
+        # Syntactically invalid (last byte before first), so the header is ignored
+        return None
+    if start:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    else:
+        # Suffix range: the last N bytes
+        start = max(size - int(end), 0)
+        end = size - 1
+    # Only a range starting at or past the end of the object is unsatisfiable
+    if start >= size:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+
 @router.get("/stream/{filename}")
-async def stream_video(filename: str, bucket: str = OUTPUT_BUCKET):
-    """Stream video from MinIO"""
+def stream_video(filename: str, request: Request, bucket: str = OUTPUT_BUCKET):
+    """Stream video from MinIO, honouring Range requests so players can seek"""
     max_retries = 3
     last_error = None
     
@@ -195,11 +312,28 @@ async def stream_video(filename: str, bucket: str = OUTPUT_BUCKET):
             # Check if file exists
             stat = minio_client.stat_object(bucket, filename)
             
+            byte_range = parse_range(request.headers.get("range"), stat.size)
+            if byte_range:
+                # Only the requested bytes are fetched from MinIO
+                start, end = byte_range
+                response = minio_client.get_object(bucket, filename, offset=start, length=end - start + 1)
+                return StreamingResponse(
+                    stream_object(response),
+                    status_code=206,
+                    media_type="video/mp4",
+                    headers={
+                        "Content-Disposition": f"inline; filename={filename}",
+                        "Content-Range": f"bytes {start}-{end}/{stat.size}",
+                        "Content-Length": str(end - start + 1),
+                        "Accept-Ranges": "bytes"
+                    }
+                )
+            
             # Get video stream
             response = minio_client.get_object(bucket, filename)
             
             return StreamingResponse(
-                response.stream(32*1024),
+                stream_object(response),
                 media_type="video/mp4",
                 headers={
                     "Content-Disposition": f"inline; filename={filename}",
@@ -207,6 +341,8 @@ async def stream_video(filename: str, bucket: str = OUTPUT_BUCKET):
                     "Accept-Ranges": "bytes"
                 }
             )
+        except HTTPException:
+            raise
         except S3Error as e:
             if e.code == "NoSuchKey":
                 raise HTTPException(status_code=404, detail="Video not found")
@@ -215,8 +351,7 @@ async def stream_video(filename: str, bucket: str = OUTPUT_BUCKET):
             if e.code == "AccessDenied" and attempt < max_retries - 1:
                 logger.warning(f"Access denied on attempt {attempt + 1}, retrying...")
                 # Small delay before retry
-                import asyncio
-                await asyncio.sleep(0.5 * (attempt + 1))
+                time.sleep(0.5 * (attempt + 1))
                 continue
             
             logger.error(f"Stream error: {e}")
@@ -232,7 +367,7 @@ async def stream_video(filename: str, bucket: str = OUTPUT_BUCKET):
 
 
 @router.get("/download/{filename}")
-async def download_video(filename: str, bucket: str = OUTPUT_BUCKET):
+def download_video(filename: str, bucket: str = OUTPUT_BUCKET):
     """Download video from MinIO"""
     try:
         if bucket not in [INPUT_BUCKET, OUTPUT_BUCKET]:
@@ -242,7 +377,7 @@ async def download_video(filename: str, bucket: str = OUTPUT_BUCKET):
         response = minio_client.get_object(bucket, filename)
         
         return StreamingResponse(
-            response.stream(32*1024),
+            stream_object(response),
             media_type="video/mp4",
             headers={
                 "Content-Disposition": f"attachment; filename={filename}",
@@ -256,7 +391,7 @@ async def download_video(filename: str, bucket: str = OUTPUT_BUCKET):
 
 
 @router.get("/list")
-async def list_videos(bucket: str = OUTPUT_BUCKET):
+def list_videos(bucket: str = OUTPUT_BUCKET):
     """List all videos in a bucket"""
     try:
         if bucket not in [INPUT_BUCKET, OUTPUT_BUCKET]:
@@ -278,7 +413,7 @@ async def list_videos(bucket: str = OUTPUT_BUCKET):
 
 
 @router.get("/task/{task_id}")
-async def check_task_status(task_id: str):
+def check_task_status(task_id: str):
     """Check the status of a Celery transcoding task"""
     if not CELERY_AVAILABLE:
         raise HTTPException(status_code=503, detail="Worker service not available")
@@ -299,6 +434,8 @@ async def check_task_status(task_id: str):
             'task_id': task_id,
             'state': task.state,
             'status': task.info.get('status', ''),
+            'frame': task.info.get('frame'),
+            'percent': task.info.get('percent'),
         }
     elif task.state == 'SUCCESS':
         response = {
@@ -325,16 +462,11 @@ async def check_task_status(task_id: str):
 
 
 @router.get("/status/{file_id}")
-async def check_status(file_id: str, format: str = "mp4"):
+def check_status(file_id: str, format: str = "mp4"):
     """Check if transcoded video is ready"""
     try:
         # Determine output name based on format
-        if format == "hls":
-            output_name = f"{file_id}_transcoded.m3u8"
-        elif format == "dash":
-            output_name = f"{file_id}_transcoded.mpd"
-        else:
-            output_name = f"{file_id}_transcoded.mp4"
+        output_name = get_output_name(file_id, format)
         
         # Check if output exists
         try:
@@ -360,7 +492,7 @@ async def check_status(file_id: str, format: str = "mp4"):
 
 
 @router.delete("/{filename}")
-async def delete_video(filename: str, bucket: str = OUTPUT_BUCKET):
+def delete_video(filename: str, bucket: str = OUTPUT_BUCKET):
     """Delete a video from MinIO"""
     try:
         if bucket not in [INPUT_BUCKET, OUTPUT_BUCKET]: